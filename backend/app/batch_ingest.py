@@ -0,0 +1,402 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from contextlib import closing
+from functools import lru_cache
+from typing import Optional
+from filelock import FileLock, Timeout
+from langchain_core.documents import Document
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
+from .config import BATCH_DB_PATH, OPENAI_API_KEY, OPENAI_EMBED_MODEL, PINECONE_DIMENSION
+from .embedding_store import chunk_hash, embedding_store
+from .rag_pipeline import upsert_chunks
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=1)
+def _get_client() -> AsyncOpenAI:
+    # Client OpenAI asynchrone pour la Batch API (embeddings à -50%, quotas plus élevés)
+    return AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Intervalle entre deux vérifications de l'état d'un batch (secondes)
+BATCH_POLL_INTERVAL = 30.0
+_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Erreurs réessayées avec backoff exponentiel (réseau, quotas, erreurs serveur)
+_TRANSIENT_ERRORS = (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+    sqlite3.OperationalError,
+)
+BATCH_MAX_RETRIES = 8
+# Limites de la Batch API par fichier d'entrée
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_FILE_BYTES = 200 * 1024 * 1024
+
+# Seul le worker qui détient ce verrou (jusqu'à son arrêt) reprend les batchs
+# en attente : les autres workers de la machine ne les suivent pas en double
+_resume_lock = FileLock(f"{BATCH_DB_PATH}.lock")
+
+# Références vers les tâches de suivi en cours (évite leur ramasse-miettes)
+_watchers: set[asyncio.Task] = set()
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(BATCH_DB_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS batch_jobs ("
+        "doc_id TEXT PRIMARY KEY, batch_id TEXT NOT NULL, status TEXT NOT NULL, "
+        "error TEXT, updated_at REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS batch_chunks ("
+        "doc_id TEXT NOT NULL, position INTEGER NOT NULL, "
+        "text TEXT NOT NULL, metadata TEXT NOT NULL, "
+        "PRIMARY KEY (doc_id, position))"
+    )
+    return conn
+
+def _set_status(
+    conn: sqlite3.Connection,
+    doc_id: str,
+    status: str,
+    error: Optional[str] = None,
+) -> None:
+    conn.execute(
+        "UPDATE batch_jobs SET status = ?, error = ?, updated_at = ? WHERE doc_id = ?",
+        (status, error, time.time(), doc_id),
+    )
+
+async def _with_retries(func, *args):
+    """
+    Exécute la coroutine func(*args) en réessayant les erreurs transitoires
+    (backoff exponentiel de 1s à 60s) ; les autres erreurs sont propagées.
+    """
+    delay = 1.0
+    for attempt in range(1, BATCH_MAX_RETRIES + 1):
+        try:
+            return await func(*args)
+        except _TRANSIENT_ERRORS:
+            if attempt == BATCH_MAX_RETRIES:
+                raise
+            logger.warning(
+                "Transient error (attempt %d/%d), retrying in %.0fs",
+                attempt, BATCH_MAX_RETRIES, delay, exc_info=True,
+            )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+# --- Accès SQLite (synchrones, exécutés via asyncio.to_thread) ---
+def _record_batch(batch_id: str, status: str, documents: dict[str, list[Document]]) -> None:
+    now = time.time()
+    with closing(_connect()) as conn, conn:
+        for doc_id, chunks in documents.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO batch_jobs VALUES (?, ?, ?, NULL, ?)",
+                (doc_id, batch_id, status, now),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO batch_chunks VALUES (?, ?, ?, ?)",
+                [
+                    (doc_id, position, chunk.page_content, json.dumps(chunk.metadata))
+                    for position, chunk in enumerate(chunks)
+                ],
+            )
+
+def _update_batch_status(batch_id: str, status: str) -> None:
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "UPDATE batch_jobs SET status = ?, updated_at = ? WHERE batch_id = ?",
+            (status, time.time(), batch_id),
+        )
+
+def _batch_doc_ids(batch_id: str) -> list[str]:
+    with closing(_connect()) as conn:
+        return [
+            row[0]
+            for row in conn.execute(
+                "SELECT doc_id FROM batch_jobs WHERE batch_id = ?", (batch_id,)
+            )
+        ]
+
+def _fail_batch(batch_id: str, error: str) -> None:
+    """Marque en échec les documents du batch qui ne sont pas déjà terminés."""
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "UPDATE batch_jobs SET status = 'failed', error = ?, updated_at = ? "
+            "WHERE batch_id = ? AND status != 'completed'",
+            (error, time.time(), batch_id),
+        )
+
+def _load_batch_chunks(doc_id: str) -> list[tuple[int, Document]]:
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            "SELECT position, text, metadata FROM batch_chunks "
+            "WHERE doc_id = ? ORDER BY position",
+            (doc_id,),
+        ).fetchall()
+    return [
+        (position, Document(page_content=text, metadata=json.loads(metadata)))
+        for position, text, metadata in rows
+    ]
+
+def _finish_document(doc_id: str, error: Optional[str]) -> None:
+    with closing(_connect()) as conn, conn:
+        if error is not None:
+            _set_status(conn, doc_id, "failed", error)
+            return
+        _set_status(conn, doc_id, "completed")
+        conn.execute("DELETE FROM batch_chunks WHERE doc_id = ?", (doc_id,))
+
+def _pending_batch_ids() -> list[str]:
+    placeholders = ", ".join("?" for _ in _TERMINAL_STATUSES)
+    with closing(_connect()) as conn:
+        return [
+            row[0]
+            for row in conn.execute(
+                "SELECT DISTINCT batch_id FROM batch_jobs "
+                f"WHERE status NOT IN ({placeholders})",
+                tuple(_TERMINAL_STATUSES),
+            )
+        ]
+
+def _get_batch_status(doc_id: str) -> Optional[dict]:
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT batch_id, status, error FROM batch_jobs WHERE doc_id = ?",
+            (doc_id,),
+        ).fetchone()
+    if row is None:
+        return None
+    batch_id, status, error = row
+    # batch_id vide : document ingéré sans batch (embeddings tous déjà connus)
+    return {"doc_id": doc_id, "batch_id": batch_id or None, "status": status, "error": error}
+
+# --- API ---
+def _request_line(custom_id: str, text: str) -> bytes:
+    return json.dumps(
+        {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {
+                "model": OPENAI_EMBED_MODEL,
+                "input": text,
+                "dimensions": PINECONE_DIMENSION,
+            },
+        }
+    ).encode("utf-8")
+
+def _split_batches(
+    documents: dict[str, list[Document]],
+    known: set[str],
+) -> list[tuple[dict[str, list[Document]], list[bytes]]]:
+    """
+    Répartit les documents en groupes respectant les limites de la Batch API
+    (nombre de requêtes et taille du fichier), sans couper un document.
+    Seuls les chunks absents de `known` sont demandés, une fois par groupe
+    (custom_id = hash du chunk). Lève ValueError si un document dépasse à lui
+    seul ces limites.
+    """
+    groups: list[tuple[dict[str, list[Document]], list[bytes]]] = []
+    group_docs: dict[str, list[Document]] = {}
+    group_lines: list[bytes] = []
+    group_hashes: set[str] = set()
+    group_bytes = 0
+    for doc_id, chunks in documents.items():
+        texts = {chunk_hash(chunk.page_content): chunk.page_content for chunk in chunks}
+        missing = {h: text for h, text in texts.items() if h not in known}
+        lines = [_request_line(h, text) for h, text in missing.items()]
+        size = sum(len(line) + 1 for line in lines)
+        if len(lines) > BATCH_MAX_REQUESTS or size > BATCH_MAX_FILE_BYTES:
+            raise ValueError(f"Document {doc_id} exceeds the Batch API limits")
+        if group_docs and (
+            len(group_lines) + len(lines) > BATCH_MAX_REQUESTS
+            or group_bytes + size > BATCH_MAX_FILE_BYTES
+        ):
+            groups.append((group_docs, group_lines))
+            group_docs, group_lines, group_hashes, group_bytes = {}, [], set(), 0
+        group_docs[doc_id] = chunks
+        for h, line in zip(missing, lines):
+            if h not in group_hashes:
+                group_hashes.add(h)
+                group_lines.append(line)
+                group_bytes += len(line) + 1
+    if group_docs:
+        groups.append((group_docs, group_lines))
+    return groups
+
+async def _delete_files(*file_ids: Optional[str]) -> None:
+    """Supprime les fichiers d'un batch côté OpenAI (au mieux, sans lever)."""
+    for file_id in filter(None, file_ids):
+        try:
+            await _get_client().files.delete(file_id)
+        except Exception:
+            logger.warning("Could not delete batch file %s", file_id, exc_info=True)
+
+async def _submit_batch(documents: dict[str, list[Document]], lines: list[bytes]) -> str:
+    client = _get_client()
+    input_file = await client.files.create(
+        file=("embeddings.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    try:
+        batch = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h",
+        )
+    except BaseException:
+        await _delete_files(input_file.id)
+        raise
+    await asyncio.to_thread(_record_batch, batch.id, batch.status, documents)
+    logger.info("Submitted embedding batch %s (%d chunks)", batch.id, len(lines))
+    return batch.id
+
+async def _ingest_known(documents: dict[str, list[Document]], known: dict[str, list[float]]) -> None:
+    """Upsert direct des documents dont tous les embeddings sont déjà connus."""
+    for doc_id, chunks in documents.items():
+        vectors = [known[chunk_hash(chunk.page_content)] for chunk in chunks]
+        await upsert_chunks(chunks, vectors, doc_id)
+    await asyncio.to_thread(
+        _record_batch, "", "completed", {doc_id: [] for doc_id in documents}
+    )
+
+async def submit_embedding_batches(documents: dict[str, list[Document]]) -> list[str]:
+    """
+    Soumet les chunks de plusieurs documents à la Batch API (/v1/embeddings),
+    en autant de jobs que nécessaire, enregistre le job de chaque doc_id et
+    lance leur suivi. Les chunks déjà présents dans embedding_store ne sont
+    pas ré-embeddés. Lève ValueError (avant toute soumission) si un document
+    dépasse les limites.
+    """
+    hashes = {chunk_hash(c.page_content) for chunks in documents.values() for c in chunks}
+    known = await asyncio.to_thread(embedding_store.get_many, list(hashes))
+    groups = _split_batches(documents, set(known))
+    batch_ids = []
+    for group_docs, group_lines in groups:
+        if not group_lines:
+            await _ingest_known(group_docs, known)
+            continue
+        batch_id = await _submit_batch(group_docs, group_lines)
+        # Suivi immédiat : un échec sur un groupe suivant ne l'abandonne pas
+        watch_embedding_batch(batch_id)
+        batch_ids.append(batch_id)
+    return batch_ids
+
+async def _download_embeddings(output_file_id: str) -> dict[str, list[float]]:
+    """Télécharge la sortie d'un batch : correspondance hash du chunk -> embedding."""
+    content = await _get_client().files.content(output_file_id)
+    vectors_by_id = {}
+    for line in content.text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            continue
+        vectors_by_id[item["custom_id"]] = response["body"]["data"][0]["embedding"]
+    return vectors_by_id
+
+async def _complete_embedding_batch(batch_id: str) -> None:
+    while True:
+        batch = await _with_retries(_get_client().batches.retrieve, batch_id)
+        if batch.status in _TERMINAL_STATUSES:
+            break
+        await asyncio.to_thread(_update_batch_status, batch_id, batch.status)
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+    # Les fichiers du batch sont supprimés une fois celui-ci traité (sauf en
+    # cas d'arrêt du worker : le traitement reprendra au redémarrage)
+    file_ids = (batch.input_file_id, batch.output_file_id, batch.error_file_id)
+    try:
+        await _finish_batch(batch)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        await _delete_files(*file_ids)
+        raise
+    await _delete_files(*file_ids)
+
+async def _finish_batch(batch) -> None:
+    batch_id = batch.id
+    if batch.status != "completed" or not batch.output_file_id:
+        await asyncio.to_thread(
+            _fail_batch, batch_id, f"Batch ended with status '{batch.status}'"
+        )
+        return
+
+    vectors_by_hash = await _with_retries(_download_embeddings, batch.output_file_id)
+    await asyncio.to_thread(embedding_store.put_many, vectors_by_hash)
+    for doc_id in await asyncio.to_thread(_batch_doc_ids, batch_id):
+        rows = await asyncio.to_thread(_load_batch_chunks, doc_id)
+        chunks = [chunk for _, chunk in rows]
+        hashes = [chunk_hash(chunk.page_content) for chunk in chunks]
+        # Chunks non demandés dans ce batch : embeddings déjà connus à la soumission
+        missing = [h for h in set(hashes) if h not in vectors_by_hash]
+        known = await asyncio.to_thread(embedding_store.get_many, missing)
+        vectors = [vectors_by_hash.get(h) or known.get(h) for h in hashes]
+        if not rows:
+            error = "No text could be extracted"
+        elif any(vector is None for vector in vectors):
+            error = "Missing embeddings in batch output"
+        else:
+            try:
+                await upsert_chunks(chunks, vectors, doc_id)
+                error = None
+            except Exception as e:
+                logger.exception("Upsert failed for document %s", doc_id)
+                error = str(e)
+        await asyncio.to_thread(_finish_document, doc_id, error)
+
+async def complete_embedding_batch(batch_id: str) -> None:
+    """
+    Attend la fin d'un batch, puis upsert les embeddings obtenus dans Pinecone.
+    En cas d'erreur définitive, les documents du batch sont marqués en échec.
+    """
+    try:
+        await _complete_embedding_batch(batch_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.exception("Embedding batch %s failed", batch_id)
+        try:
+            await asyncio.to_thread(_fail_batch, batch_id, str(e))
+        except Exception:
+            logger.exception("Could not record failure of batch %s", batch_id)
+
+def watch_embedding_batch(batch_id: str) -> None:
+    """Lance le suivi d'un batch en tâche de fond."""
+    task = asyncio.create_task(complete_embedding_batch(batch_id))
+    _watchers.add(task)
+    task.add_done_callback(_watchers.discard)
+
+async def resume_pending_batches() -> None:
+    """
+    Reprend le suivi des batchs non terminés (après un redémarrage).
+    Sans effet si un autre worker détient déjà le verrou de reprise.
+    """
+    try:
+        _resume_lock.acquire(timeout=0)
+    except Timeout:
+        return
+    for batch_id in await asyncio.to_thread(_pending_batch_ids):
+        watch_embedding_batch(batch_id)
+
+def release_resume_lock() -> None:
+    """Libère le verrou de reprise à l'arrêt du worker."""
+    if _resume_lock.is_locked:
+        _resume_lock.release()
+
+async def get_batch_status(doc_id: str) -> Optional[dict]:
+    """Renvoie l'état du job d'ingestion d'un document, ou None."""
+    return await asyncio.to_thread(_get_batch_status, doc_id)
@@ -13,5 +13,10 @@ PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_CLOUD = os.getenv("PINECONE_CLOUD", "aws")
 PINECONE_ENV = os.getenv("PINECONE_ENV", "us-east-1")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", "pdf-rag-index")
-PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE") or None
-PINECONE_DIMENSION = int(os.getenv("PINECONE_DIMENSION", "1536"))
\ No newline at end of file
+PINECONE_DIMENSION = int(os.getenv("PINECONE_DIMENSION", "512"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH") or None
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+BATCH_DB_PATH = os.getenv("BATCH_DB_PATH", os.path.join(basedir, "batch_jobs.sqlite3"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(basedir, "embeddings.sqlite3"))
+# Taille maximale acceptée pour un PDF uploadé (octets)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
\ No newline at end of file
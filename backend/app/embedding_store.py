@@ -0,0 +1,67 @@
+from __future__ import annotations
+import hashlib
+import sqlite3
+from contextlib import closing
+import numpy as np
+from .config import EMBEDDING_CACHE_PATH, OPENAI_EMBED_MODEL, PINECONE_DIMENSION
+
+def l2_normalize(vectors: list[list[float]]) -> list[list[float]]:
+    """Normalise chaque vecteur (norme L2 = 1), en une opération vectorisée."""
+    if not vectors:
+        return []
+    V = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(V, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (V / norms).tolist()
+
+def chunk_hash(text: str) -> str:
+    # Le modèle et la dimension font partie de la clé : changer l'un ou l'autre
+    # ne doit pas réutiliser d'anciens vecteurs
+    key = f"{OPENAI_EMBED_MODEL}:{PINECONE_DIMENSION}:{text}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    """
+    Cache persistant (SQLite) des embeddings de chunks, indexé par le SHA-256
+    de leur contenu : un chunk déjà vu n'est pas ré-embeddé.
+    """
+
+    # Nombre maximal de paramètres par requête SQL
+    _QUERY_BATCH_SIZE = 500
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        return conn
+
+    def get_many(self, hashes: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with closing(self._connect()) as conn:
+            for i in range(0, len(hashes), self._QUERY_BATCH_SIZE):
+                batch = hashes[i : i + self._QUERY_BATCH_SIZE]
+                placeholders = ", ".join("?" for _ in batch)
+                rows = conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE hash IN ({placeholders})",
+                    batch,
+                )
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items: dict[str, list[float]]) -> None:
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                [
+                    (h, np.asarray(vector, dtype=np.float32).tobytes())
+                    for h, vector in items.items()
+                ],
+            )
+
+# Embeddings déjà calculés, partagés par l'ingestion directe et la Batch API
+embedding_store = EmbeddingStore(EMBEDDING_CACHE_PATH)
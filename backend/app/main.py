@@ -1,12 +1,74 @@
-import os
-import shutil
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from contextlib import asynccontextmanager
 from typing import List, Optional
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from .rag_pipeline import ingest_pdf, build_qa_chain
+from fastapi.responses import StreamingResponse
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from pydantic import BaseModel, Field
+from .batch_ingest import (
+    get_batch_status,
+    release_resume_lock,
+    resume_pending_batches,
+    submit_embedding_batches,
+)
+from .config import (
+    MAX_UPLOAD_BYTES,
+    PINECONE_DIMENSION,
+    SEMANTIC_CACHE_PATH,
+    SEMANTIC_CACHE_THRESHOLD,
+)
+from .query_cache import QueryCache, SemanticCache
+from .rag_pipeline import (
+    aretrieve,
+    astream_answer,
+    build_qa_chain,
+    check_config,
+    delete_document,
+    ensure_pinecone_index,
+    get_embeddings,
+    ingest_pdf,
+    load_chunks,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Cycle de vie ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Vérifie la configuration et prépare l'index Pinecone au démarrage de
+    chaque worker plutôt qu'à l'import des modules. Les clients sont créés
+    à la première utilisation par les getters de rag_pipeline.
+    """
+    check_config()
+    await asyncio.to_thread(ensure_pinecone_index)
+    semantic_cache.load()
+    await resume_pending_batches()
+    yield
+    release_resume_lock()
+    semantic_cache.save()
 
-app = FastAPI(title="RAG Chatbot Workshop")
+app = FastAPI(title="RAG Chatbot Workshop", lifespan=lifespan)
+
+# Nombre maximal de questions par appel à /chat-batch, et traitées simultanément
+CHAT_BATCH_MAX_QUESTIONS = 50
+CHAT_BATCH_CONCURRENCY = 8
+# Taille des blocs lus lors de l'upload d'un PDF
+UPLOAD_CHUNK_SIZE = 1 << 16
+
+# Cache des réponses de /chat, indexé par (doc_id, question, historique)
+query_cache = QueryCache(max_size=1024, ttl=600)
+# Cache sémantique pour les questions proches (sans historique)
+semantic_cache = SemanticCache(
+    dimension=PINECONE_DIMENSION,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    path=SEMANTIC_CACHE_PATH,
+)
 
 # Configuration CORS (Cross-Origin Resource Sharing)
 app.add_middleware(
@@ -31,53 +93,219 @@ class ChatResponse(BaseModel):
     answer: str
     sources: Optional[list] = None
 
+class ChatBatchRequest(BaseModel):
+    doc_id: str
+    questions: List[str] = Field(..., min_length=1, max_length=CHAT_BATCH_MAX_QUESTIONS)
+
+def _cache_key(request: ChatRequest) -> str:
+    history = [(msg.role, msg.content) for msg in request.history or []]
+    history_hash = hashlib.sha256(json.dumps(history).encode()).hexdigest()
+    payload = json.dumps([request.doc_id, request.question, history_hash])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _history_messages(request: ChatRequest) -> list[BaseMessage]:
+    # Conversion de l'historique en messages pour le LLM
+    return [
+        (HumanMessage if msg.role == "user" else AIMessage)(content=msg.content)
+        for msg in request.history or []
+    ]
+
+def _extract_sources(docs) -> list:
+    # Extraction des sources pour citation
+    return [
+        {
+            "page_number": doc.metadata.get("page_number"),
+            "snippet": f"{doc.page_content[:200]}...",
+        }
+        for doc in docs
+    ]
+
+async def _read_upload(file: UploadFile) -> bytes:
+    """
+    Lit en mémoire un PDF uploadé, par blocs, et refuse (413) les fichiers
+    dépassant MAX_UPLOAD_BYTES.
+    """
+    if file.content_type != "application/pdf":
+        raise HTTPException(status_code=400, detail="File must be a PDF.")
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"{file.filename}: file too large.")
+    data = bytearray()
+    while block := await file.read(UPLOAD_CHUNK_SIZE):
+        data += block
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"{file.filename}: file too large.")
+    return bytes(data)
+
 # --- Endpoints ---
 @app.post("/upload-pdf")
 async def upload_pdf(file: UploadFile = File(...)):
     """Endpoint pour uploader et ingérer un PDF."""
-    if file.content_type != "application/pdf":
-        raise HTTPException(status_code=400, detail="File must be a PDF.")
-    # Sauvegarde temporaire
-    temp_dir = "tmp_uploads"
-    os.makedirs(temp_dir, exist_ok=True)
-    file_path = os.path.join(temp_dir, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    data = await _read_upload(file)
     try:
         # Appel à notre pipeline d'ingestion
-        doc_id = ingest_pdf(file_path)
+        doc_id = await ingest_pdf(data, source=file.filename)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Nettoyage
-        if os.path.exists(file_path):
-            os.remove(file_path)
+    query_cache.invalidate(doc_id)
+    semantic_cache.invalidate(doc_id)
     return {"doc_id": doc_id, "message": "PDF processed successfully"}
 
+@app.post("/upload-pdf-bulk")
+async def upload_pdf_bulk(files: List[UploadFile] = File(...)):
+    """
+    Endpoint pour ingérer plusieurs PDF via la Batch API d'OpenAI.
+    Les embeddings sont calculés en différé ; l'avancement se suit avec
+    GET /upload-pdf-bulk/{doc_id}.
+    """
+    documents = {}
+    for file in files:
+        data = await _read_upload(file)
+        doc_id = str(uuid.uuid4())
+        try:
+            chunks = await asyncio.to_thread(load_chunks, data, doc_id, file.filename)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        # Un PDF sans texte (ex. scanné) n'aurait aucun vecteur : refusé d'emblée
+        if not chunks:
+            raise HTTPException(
+                status_code=400, detail=f"{file.filename}: no text could be extracted."
+            )
+        documents[doc_id] = chunks
+        # Seuls les chunks sont conservés jusqu'à la soumission du batch
+        del data
+        await file.close()
+    try:
+        batch_ids = await submit_embedding_batches(documents)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error submitting batch: {e}")
+    return {
+        "batch_ids": batch_ids,
+        "doc_ids": list(documents),
+        "message": "PDF batch submitted",
+    }
+
+@app.get("/upload-pdf-bulk/{doc_id}")
+async def upload_pdf_bulk_status(doc_id: str):
+    """Endpoint pour suivre l'ingestion différée d'un document."""
+    status = await get_batch_status(doc_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown document.")
+    return status
+
+@app.delete("/documents/{doc_id}")
+async def delete_doc(doc_id: str):
+    """Endpoint pour supprimer un document et ses vecteurs."""
+    try:
+        deleted = await delete_document(doc_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Unknown document.")
+    query_cache.invalidate(doc_id)
+    semantic_cache.invalidate(doc_id)
+    return {"doc_id": doc_id, "message": "Document deleted successfully"}
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat_with_doc(request: ChatRequest):
     """Endpoint pour poser une question sur un document."""
+    cache_key = _cache_key(request)
+    cached = query_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    # La réponse dépend de l'historique : le cache sémantique ne sert qu'aux
+    # questions posées sans historique
+    question_embedding = None
+    if not request.history:
+        question_embedding = await get_embeddings().aembed_query(request.question)
+        similar = semantic_cache.get(request.doc_id, question_embedding)
+        if similar is not None:
+            return ChatResponse(**similar)
     try:
         qa_chain = build_qa_chain(request.doc_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error building QA chain: {e}")
-    # Gestion basique de l'historique
-    history_text = ""
-    if request.history:
-        for msg in request.history:
-            prefix = "User" if msg.role == "user" else "Assistant"
-            history_text += f"{prefix}: {msg.content}\n"
-    question_with_history = history_text + f"User: {request.question}"
     # Exécution de la chaîne
-    result = qa_chain.invoke(question_with_history)
+    result = await qa_chain.ainvoke(
+        {"question": request.question, "history": _history_messages(request)}
+    )
     answer = result["answer"]
-    # Extraction des sources pour citation
-    sources = []
-    for doc in result.get("source_documents", []):
-        sources.append(
-            {
-                "page_number": doc.metadata.get("page_number"),
-                "snippet": doc.page_content[:200] + "...",
-            }
+    sources = _extract_sources(result.get("source_documents", []))
+    response = ChatResponse(answer=answer, sources=sources)
+    query_cache.put(cache_key, request.doc_id, response)
+    if question_embedding is not None:
+        semantic_cache.put(request.doc_id, question_embedding, response.model_dump())
+    return response
+
+@app.post("/chat-batch", response_model=List[ChatResponse])
+async def chat_batch(request: ChatBatchRequest):
+    """
+    Endpoint pour poser plusieurs questions (sans historique) sur un document.
+    Les questions déjà en cache sont servies directement, les autres sont
+    exécutées en parallèle par la chaîne.
+    """
+    chat_requests = [
+        ChatRequest(doc_id=request.doc_id, question=question)
+        for question in request.questions
+    ]
+    cache_keys = [_cache_key(r) for r in chat_requests]
+    responses: List[Optional[ChatResponse]] = [query_cache.get(k) for k in cache_keys]
+    pending = [i for i, response in enumerate(responses) if response is None]
+    # Cache sémantique : embeddings des questions restantes en un seul appel
+    question_embeddings = []
+    if pending:
+        question_embeddings = await get_embeddings().aembed_queries(
+            [chat_requests[i].question for i in pending]
         )
-    return ChatResponse(answer=answer, sources=sources)
\ No newline at end of file
+    embedding_by_index = dict(zip(pending, question_embeddings))
+    for i, embedding in embedding_by_index.items():
+        similar = semantic_cache.get(request.doc_id, embedding)
+        if similar is not None:
+            responses[i] = ChatResponse(**similar)
+    pending = [i for i in pending if responses[i] is None]
+    if pending:
+        try:
+            qa_chain = build_qa_chain(request.doc_id)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error building QA chain: {e}")
+        results = await qa_chain.abatch(
+            [{"question": chat_requests[i].question, "history": []} for i in pending],
+            config={"max_concurrency": CHAT_BATCH_CONCURRENCY},
+        )
+        for i, result in zip(pending, results):
+            response = ChatResponse(
+                answer=result["answer"],
+                sources=_extract_sources(result.get("source_documents", [])),
+            )
+            query_cache.put(cache_keys[i], request.doc_id, response)
+            semantic_cache.put(request.doc_id, embedding_by_index[i], response.model_dump())
+            responses[i] = response
+    return responses
+
+@app.post("/chat-stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Variante de /chat qui renvoie la réponse en Server-Sent Events :
+    un événement {"delta": ...} par token, puis {"sources": [...]} à la fin
+    (ou {"error": ...} si la génération échoue).
+    """
+    history = _history_messages(request)
+    try:
+        docs = await aretrieve(request.doc_id, request.question)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving context: {e}")
+
+    async def token_iter():
+        # Les en-têtes sont déjà envoyés : une erreur en cours de génération
+        # est signalée au client par un dernier événement {"error": ...}
+        try:
+            async for delta in astream_answer(docs, request.question, history):
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+        except Exception as e:
+            logger.exception("Streaming failed for document %s", request.doc_id)
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            return
+        yield f"data: {json.dumps({'sources': _extract_sources(docs)})}\n\n"
+
+    return StreamingResponse(token_iter(), media_type="text/event-stream")
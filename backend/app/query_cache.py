@@ -0,0 +1,338 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+import numpy as np
+from filelock import FileLock
+from langchain_core.embeddings import Embeddings
+from .embedding_store import l2_normalize
+
+logger = logging.getLogger(__name__)
+
+# Nombre maximal de documents supprimés mémorisés dans le fichier du cache sémantique
+MAX_TOMBSTONES = 10000
+
+class QueryCache:
+    """
+    Cache LRU en mémoire avec expiration (TTL) pour les réponses de /chat.
+    Chaque entrée est rattachée à un doc_id pour pouvoir être invalidée.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 600.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[str, float, Any]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            _, expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, doc_id: str, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (doc_id, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, doc_id: str) -> None:
+        """Supprime toutes les entrées associées à un document."""
+        with self._lock:
+            stale = [k for k, (d, _, _) in self._entries.items() if d == doc_id]
+            for key in stale:
+                del self._entries[key]
+
+class _DocEntries:
+    """
+    Entrées du cache sémantique d'un document : matrice et réponses, gérées
+    en tampon circulaire une fois la capacité atteinte (la plus ancienne
+    entrée est écrasée, sans décaler la matrice).
+    """
+
+    __slots__ = ("M", "answers", "cursor")
+
+    def __init__(self, dimension: int, capacity: int) -> None:
+        self.M = np.empty((min(16, capacity), dimension), dtype=np.float32)
+        self.answers: list[Any] = []
+        # Position de la plus ancienne entrée (utilisée une fois plein)
+        self.cursor = 0
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def add(self, q: np.ndarray, value: Any, capacity: int) -> None:
+        n = len(self.answers)
+        if n >= capacity:
+            self.M[self.cursor] = q
+            self.answers[self.cursor] = value
+            self.cursor = (self.cursor + 1) % n
+            return
+        if n == self.M.shape[0]:
+            # Doublement de la capacité pour éviter un vstack à chaque insertion
+            grown = np.empty((min(2 * n, capacity), self.M.shape[1]), dtype=np.float32)
+            grown[:n] = self.M
+            self.M = grown
+        self.M[n] = q
+        self.answers.append(value)
+
+    def rows(self) -> tuple[np.ndarray, list[Any]]:
+        """Embeddings et réponses, de la plus ancienne à la plus récente."""
+        n = len(self.answers)
+        order = np.r_[self.cursor : n, 0 : self.cursor]
+        return self.M[order], [self.answers[i] for i in order]
+
+class SemanticCache:
+    """
+    Cache sémantique : retrouve une réponse déjà calculée pour une question
+    proche (similarité cosinus >= threshold) sur le même document.
+    Chaque document a sa propre matrice (n, dim) float32 d'embeddings
+    normalisés : une recherche se résume à un produit matrice-vecteur sur les
+    seules entrées du document. Les documents les moins récemment utilisés
+    sont évincés au-delà de max_docs.
+    Les valeurs stockées doivent être sérialisables en JSON.
+    """
+
+    def __init__(
+        self,
+        dimension: int,
+        threshold: float = 0.95,
+        max_per_doc: int = 64,
+        max_docs: int = 128,
+        path: Optional[str] = None,
+    ) -> None:
+        self.dimension = dimension
+        self.threshold = threshold
+        self.max_per_doc = max_per_doc
+        self.max_docs = max_docs
+        self.path = path
+        self._docs: OrderedDict[str, _DocEntries] = OrderedDict()
+        # Documents supprimés depuis le démarrage, exclus lors de la sauvegarde
+        self._deleted: set[str] = set()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(entries) for entries in self._docs.values())
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        q = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(q)
+        return q / norm if norm else q
+
+    def get(self, doc_id: str, embedding) -> Optional[Any]:
+        q = self._normalize(embedding)
+        with self._lock:
+            entries = self._docs.get(doc_id)
+            if entries is None or not len(entries):
+                return None
+            self._docs.move_to_end(doc_id)
+            scores = entries.M[: len(entries)] @ q
+            i = int(scores.argmax())
+            if scores[i] >= self.threshold:
+                return entries.answers[i]
+            return None
+
+    def put(self, doc_id: str, embedding, value: Any) -> None:
+        self._insert(doc_id, self._normalize(embedding), value)
+
+    def _insert(self, doc_id: str, q: np.ndarray, value: Any) -> None:
+        with self._lock:
+            entries = self._docs.get(doc_id)
+            if entries is None:
+                entries = self._docs[doc_id] = _DocEntries(self.dimension, self.max_per_doc)
+                if len(self._docs) > self.max_docs:
+                    self._docs.popitem(last=False)
+            else:
+                self._docs.move_to_end(doc_id)
+            entries.add(q, value, self.max_per_doc)
+
+    def invalidate(self, doc_id: str) -> None:
+        """Supprime toutes les entrées associées à un document."""
+        with self._lock:
+            self._docs.pop(doc_id, None)
+            self._deleted.add(doc_id)
+
+    def _read_file(self, target: str) -> Optional[tuple[list, np.ndarray, list, list]]:
+        """
+        Lit un cache sauvegardé : (doc_ids, matrice, réponses, documents supprimés).
+        Renvoie None (avec un avertissement) si le fichier est illisible ou incohérent.
+        """
+        try:
+            with np.load(target) as data:
+                matrix = data["matrix"].astype(np.float32)
+                meta = json.loads(str(data["meta"]))
+            doc_ids = meta["doc_ids"]
+            answers = meta["answers"]
+            deleted = meta.get("deleted", [])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning("Ignoring unreadable semantic cache %s: %s", target, e)
+            return None
+        if (
+            matrix.ndim != 2
+            or matrix.shape[1] != self.dimension
+            or not isinstance(doc_ids, list)
+            or not isinstance(answers, list)
+            or not isinstance(deleted, list)
+            or not len(doc_ids) == len(answers) == matrix.shape[0]
+        ):
+            logger.warning("Ignoring inconsistent semantic cache %s", target)
+            return None
+        return doc_ids, matrix, answers, deleted
+
+    def save(self) -> None:
+        """
+        Fusionne les entrées en mémoire avec celles déjà sauvegardées (par
+        d'autres workers), sous verrou fichier, puis écrit le résultat dans un
+        fichier temporaire renommé (os.replace). Les documents supprimés par
+        n'importe quel worker sont mémorisés dans le fichier et exclus.
+        """
+        if not self.path:
+            return
+        target = f"{self.path}.npz"
+        with FileLock(f"{target}.lock"):
+            on_disk = self._read_file(target) if os.path.exists(target) else None
+            disk_ids, disk_matrix, disk_answers, disk_deleted = on_disk or ([], [], [], [])
+            with self._lock:
+                deleted = list(dict.fromkeys([*disk_deleted, *self._deleted]))
+                in_memory = [(doc_id, *entries.rows()) for doc_id, entries in self._docs.items()]
+            deleted = deleted[-MAX_TOMBSTONES:]
+            gone = set(deleted)
+
+            # doc_id -> {octets de l'embedding: (embedding, réponse)}, du plus ancien au plus récent
+            merged: dict[str, dict[bytes, tuple[np.ndarray, Any]]] = {}
+            for doc_id, row, answer in zip(disk_ids, disk_matrix, disk_answers):
+                if doc_id not in gone:
+                    merged.setdefault(doc_id, {})[row.tobytes()] = (row, answer)
+            for doc_id, matrix, answers in in_memory:
+                if doc_id in gone:
+                    continue
+                rows = merged[doc_id] = merged.pop(doc_id, {})
+                for row, answer in zip(matrix, answers):
+                    rows.pop(row.tobytes(), None)
+                    rows[row.tobytes()] = (row, answer)
+
+            doc_ids, vectors, answers = [], [], []
+            for doc_id in list(merged)[-self.max_docs :]:
+                for row, answer in list(merged[doc_id].values())[-self.max_per_doc :]:
+                    doc_ids.append(doc_id)
+                    vectors.append(row)
+                    answers.append(answer)
+            matrix = (
+                np.stack(vectors)
+                if vectors
+                else np.empty((0, self.dimension), dtype=np.float32)
+            )
+            meta = json.dumps({"doc_ids": doc_ids, "answers": answers, "deleted": deleted})
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(target)), suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.savez(f, matrix=matrix, meta=np.array(meta))
+                os.replace(tmp_path, target)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def load(self) -> None:
+        """
+        Recharge un cache précédemment sauvegardé. Un fichier absent, illisible
+        ou incohérent laisse le cache vide (avec un avertissement).
+        """
+        if not self.path:
+            return
+        target = f"{self.path}.npz"
+        if not os.path.exists(target):
+            return
+        on_disk = self._read_file(target)
+        if on_disk is None:
+            return
+        doc_ids, matrix, answers, _ = on_disk
+        with self._lock:
+            self._docs.clear()
+            for doc_id, row, answer in zip(doc_ids, matrix, answers):
+                # Les lignes sauvegardées sont déjà normalisées
+                self._insert(doc_id, row, answer)
+
+class CachedEmbeddings(Embeddings):
+    """
+    Enveloppe un modèle d'embeddings et garde en cache (LRU) les embeddings
+    des questions, pour éviter un appel OpenAI quand une question revient.
+    Les embeddings de documents ne sont pas mis en cache.
+    Avec normalize=True, les embeddings des questions sont normalisés (L2).
+    """
+
+    def __init__(
+        self,
+        inner: Embeddings,
+        max_size: int = 4096,
+        normalize: bool = False,
+    ) -> None:
+        self.inner = inner
+        self.max_size = max_size
+        self.normalize = normalize
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _get(self, text: str) -> Optional[list[float]]:
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+            return vector
+
+    def _put(self, text: str, vector: list[float]) -> list[float]:
+        if self.normalize:
+            vector = l2_normalize([vector])[0]
+        with self._lock:
+            self._cache[text] = vector
+            self._cache.move_to_end(text)
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.inner.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.inner.aembed_documents(texts)
+
+    async def aembed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeddings de plusieurs questions : celles absentes du cache sont
+        calculées en un seul appel (aembed_documents, équivalent à
+        aembed_query pour les embeddings OpenAI) puis mises en cache.
+        """
+        vectors = [self._get(text) for text in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            computed = await self.inner.aembed_documents(missing)
+            by_text = {t: self._put(t, v) for t, v in zip(missing, computed)}
+            vectors = [v if v is not None else by_text[t] for t, v in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = self._get(text)
+        if vector is None:
+            vector = self._put(text, self.inner.embed_query(text))
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        vector = self._get(text)
+        if vector is None:
+            vector = self._put(text, await self.inner.aembed_query(text))
+        return vector
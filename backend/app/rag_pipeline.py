@@ -1,20 +1,29 @@
 from __future__ import annotations
+import asyncio
 import logging
+import os
+import tempfile
 import time
 import uuid
-from typing import Optional
-from langchain_community.document_loaders import PyPDFLoader
+from functools import lru_cache
+from operator import itemgetter
+from typing import AsyncIterator, Optional
+import pymupdf
+from filelock import FileLock
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import (
-    RunnableLambda,
+    Runnable,
     RunnableParallel,
-    RunnablePassthrough,
 )
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pinecone import Pinecone
+from pinecone.exceptions import NotFoundException
 from .config import (
     OPENAI_API_KEY,
     OPENAI_CHAT_MODEL,
@@ -23,95 +32,257 @@ from .config import (
     PINECONE_API_KEY,
     PINECONE_DIMENSION,
     PINECONE_INDEX_NAME,
-    PINECONE_NAMESPACE,
 )
+from .embedding_store import chunk_hash, embedding_store, l2_normalize
+from .query_cache import CachedEmbeddings
 
 logger = logging.getLogger(__name__)
 
-# Vérification des clés API
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY is not configured.")
-if not PINECONE_API_KEY:
-    raise RuntimeError("PINECONE_API_KEY is not configured.")
+def check_config() -> None:
+    """Vérification des clés API."""
+    if not OPENAI_API_KEY:
+        raise RuntimeError("OPENAI_API_KEY is not configured.")
+    if not PINECONE_API_KEY:
+        raise RuntimeError("PINECONE_API_KEY is not configured.")
 
-# Initialisation du client Pinecone
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# Les clients sont créés au premier usage (au démarrage de l'application,
+# via le lifespan FastAPI) et non à l'import du module.
+@lru_cache(maxsize=1)
+def get_pinecone() -> Pinecone:
+    return Pinecone(api_key=PINECONE_API_KEY)
+
+@lru_cache(maxsize=1)
+def get_index():
+    return get_pinecone().Index(PINECONE_INDEX_NAME)
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> Embeddings:
+    # Les embeddings des questions sont mis en cache (questions répétées)
+    return CachedEmbeddings(
+        OpenAIEmbeddings(
+            api_key=OPENAI_API_KEY,
+            model=OPENAI_EMBED_MODEL,
+            dimensions=PINECONE_DIMENSION,
+        ),
+        max_size=4096,
+        normalize=True,
+    )
+
+@lru_cache(maxsize=1)
+def get_llm() -> ChatOpenAI:
+    return ChatOpenAI(
+        api_key=OPENAI_API_KEY,
+        model=OPENAI_CHAT_MODEL,
+        temperature=OPENAI_TEMPERATURE,
+    )
+
+# Les vecteurs sont normalisés côté client : le produit scalaire équivaut au
+# cosinus sans renormalisation par Pinecone à chaque requête
+PINECONE_METRIC = "dotproduct"
+
+# Délai maximal d'attente de l'index Pinecone (secondes)
+INDEX_READY_TIMEOUT = 60.0
+
+# Verrou partagé par les workers d'une même machine
+INDEX_LOCK_PATH = os.path.join(tempfile.gettempdir(), f"{PINECONE_INDEX_NAME}.lock")
+
+def ensure_pinecone_index() -> None:
+    """
+    Crée l'index Pinecone s'il n'existe pas déjà et attend qu'il soit prêt.
+    Un verrou fichier évite que plusieurs workers le créent en même temps.
+    """
+    with FileLock(INDEX_LOCK_PATH):
+        _ensure_pinecone_index()
 
 def _ensure_pinecone_index() -> None:
-    """Crée l'index Pinecone s'il n'existe pas déjà."""
+    pc = get_pinecone()
     existing_indexes = [i.name for i in pc.list_indexes()]
-    if PINECONE_INDEX_NAME in existing_indexes:
-        return
-    logger.info("Creating Pinecone index '%s'...", PINECONE_INDEX_NAME)
-    pc.create_index(
-        name=PINECONE_INDEX_NAME,
-        dimension=PINECONE_DIMENSION,
-        metric="cosine",
-        spec={"serverless": {"cloud": "aws", "region": "us-east-1"}} # Adapter selon config
-    )
-    # Attente que l'index soit prêt
-    while True:
+    if PINECONE_INDEX_NAME not in existing_indexes:
+        logger.info("Creating Pinecone index '%s'...", PINECONE_INDEX_NAME)
+        pc.create_index(
+            name=PINECONE_INDEX_NAME,
+            dimension=PINECONE_DIMENSION,
+            metric=PINECONE_METRIC,
+            spec={"serverless": {"cloud": "aws", "region": "us-east-1"}} # Adapter selon config
+        )
+    # Un index existant doit avoir la même dimension et la même métrique
+    idx = pc.describe_index(PINECONE_INDEX_NAME)
+    if idx.dimension != PINECONE_DIMENSION:
+        raise RuntimeError(
+            f"Pinecone index '{PINECONE_INDEX_NAME}' has dimension {idx.dimension}, "
+            f"expected {PINECONE_DIMENSION}. Recreate the index or set PINECONE_DIMENSION."
+        )
+    if idx.metric != PINECONE_METRIC:
+        raise RuntimeError(
+            f"Pinecone index '{PINECONE_INDEX_NAME}' uses metric '{idx.metric}', "
+            f"expected '{PINECONE_METRIC}'. Recreate the index."
+        )
+    # Attente que l'index soit prêt (backoff exponentiel plafonné à 2s)
+    delay = 0.1
+    deadline = time.monotonic() + INDEX_READY_TIMEOUT
+    while not idx.status["ready"]:
+        if time.monotonic() >= deadline:
+            raise RuntimeError(
+                f"Pinecone index '{PINECONE_INDEX_NAME}' is not ready "
+                f"after {INDEX_READY_TIMEOUT:.0f}s."
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
         idx = pc.describe_index(PINECONE_INDEX_NAME)
-        if idx.status["ready"]:
-            break
-        time.sleep(1)
 
-_ensure_pinecone_index()
-
-# Initialisation des modèles LangChain
-embeddings = OpenAIEmbeddings(
-    api_key=OPENAI_API_KEY,
-    model=OPENAI_EMBED_MODEL,
-    dimensions=PINECONE_DIMENSION,
-)
-llm = ChatOpenAI(
-    api_key=OPENAI_API_KEY,
-    model=OPENAI_CHAT_MODEL,
-    temperature=OPENAI_TEMPERATURE,
-)
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=1000,
     chunk_overlap=150,
     add_start_index=True,
 )
 
-def ingest_pdf(file_path: str, doc_id: Optional[str] = None) -> str:
+@lru_cache(maxsize=1)
+def get_vectorstore() -> PineconeVectorStore:
     """
-    Charge un PDF, le découpe et stocke les vecteurs dans Pinecone.
+    Vector store partagé : seul le namespace interrogé dépend du document.
+    Créé au premier usage, une fois l'index Pinecone prêt.
     """
-    document_id = doc_id or str(uuid.uuid4())
-    loader = PyPDFLoader(file_path)
-    pages = loader.load()
-    # Ajout de métadonnées pour le filtrage
-    for i, page in enumerate(pages, start=1):
-        page.metadata["doc_id"] = document_id
-        page.metadata["page_number"] = page.metadata.get("page", i)
+    return PineconeVectorStore.from_existing_index(
+        index_name=PINECONE_INDEX_NAME,
+        embedding=get_embeddings(),
+    )
+
+# Nombre de vecteurs envoyés par requête d'upsert Pinecone
+UPSERT_BATCH_SIZE = 100
+# Taille des lots d'embedding et nombre d'appels OpenAI simultanés
+EMBED_BATCH_SIZE = 256
+EMBED_CONCURRENCY = 8
+
+async def _embed_texts(texts: list[str]) -> list[list[float]]:
+    """
+    Calcule les embeddings par lots de EMBED_BATCH_SIZE, envoyés en parallèle.
+    """
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def run(batch: list[str]) -> list[list[float]]:
+        async with sem:
+            return await get_embeddings().aembed_documents(batch)
+
+    batches = [
+        texts[i : i + EMBED_BATCH_SIZE]
+        for i in range(0, len(texts), EMBED_BATCH_SIZE)
+    ]
+    results = await asyncio.gather(*(run(batch) for batch in batches))
+    return [vector for batch in results for vector in batch]
+
+def load_chunks(
+    pdf: bytes,
+    document_id: str,
+    source: Optional[str] = None,
+) -> list[Document]:
+    """
+    Charge un PDF en mémoire avec PyMuPDF et le découpe en chunks portant
+    le doc_id et le numéro de page.
+    """
+    with pymupdf.open(stream=pdf, filetype="pdf") as pdf_doc:
+        # Ajout de métadonnées pour le filtrage (PyMuPDF numérote les pages à partir de 0)
+        pages = [
+            Document(
+                page_content=page.get_text(),
+                metadata={
+                    "source": source or "",
+                    "page": page.number,
+                    "page_number": page.number + 1,
+                    "total_pages": pdf_doc.page_count,
+                    "doc_id": document_id,
+                },
+            )
+            for page in pdf_doc
+        ]
     chunks = text_splitter.split_documents(pages)
     # S'assurer que chaque chunk a le doc_id
     for chunk in chunks:
         chunk.metadata.setdefault("doc_id", document_id)
-    PineconeVectorStore.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        index_name=PINECONE_INDEX_NAME,
-        namespace=None,
+    return chunks
+
+async def upsert_chunks(
+    chunks: list[Document],
+    vectors: list[list[float]],
+    document_id: str,
+) -> None:
+    """
+    Upsert par lots des chunks et de leurs embeddings dans le namespace du document.
+    """
+    # Normalisation L2 (métrique dotproduct)
+    vectors = l2_normalize(vectors)
+    # Identifiants déterministes : un nouvel upsert (reprise d'un batch par un
+    # autre worker, ré-ingestion) écrase les vecteurs au lieu de les dupliquer
+    records = [
+        (f"{document_id}-{i}", vector, {**chunk.metadata, "text": chunk.page_content})
+        for i, (chunk, vector) in enumerate(zip(chunks, vectors))
+    ]
+    await asyncio.to_thread(
+        get_index().upsert,
+        vectors=records,
+        namespace=document_id,
+        batch_size=UPSERT_BATCH_SIZE,
+        show_progress=False,
+    )
+
+async def ingest_pdf(
+    pdf: bytes,
+    doc_id: Optional[str] = None,
+    source: Optional[str] = None,
+) -> str:
+    """
+    Charge un PDF, le découpe et stocke les vecteurs dans Pinecone.
+    """
+    document_id = doc_id or str(uuid.uuid4())
+    chunks = await asyncio.to_thread(load_chunks, pdf, document_id, source)
+    # Seuls les chunks jamais vus sont embeddés (par lots parallèles)
+    hashes = [chunk_hash(chunk.page_content) for chunk in chunks]
+    known = await asyncio.to_thread(embedding_store.get_many, list(set(hashes)))
+    unknown = {
+        h: chunk.page_content
+        for h, chunk in zip(hashes, chunks)
+        if h not in known
+    }
+    if unknown:
+        new_vectors = dict(zip(unknown, await _embed_texts(list(unknown.values()))))
+        await asyncio.to_thread(embedding_store.put_many, new_vectors)
+        known.update(new_vectors)
+    logger.info(
+        "Document %s: %d chunks, %d new embeddings", document_id, len(chunks), len(unknown)
     )
+    vectors = [known[h] for h in hashes]
+    await upsert_chunks(chunks, vectors, document_id)
     return document_id
 
+async def delete_document(doc_id: str) -> bool:
+    """
+    Supprime tous les vecteurs d'un document (son namespace Pinecone).
+    Renvoie False si le document n'existe pas.
+    """
+    try:
+        await asyncio.to_thread(
+            get_index().delete,
+            delete_all=True,
+            namespace=doc_id,
+        )
+    except NotFoundException:
+        return False
+    return True
+
 def get_retriever_for_doc(doc_id: str):
     """
     Crée un 'retriever' qui ne cherche QUE dans le document spécifié.
+    Chaque document est stocké dans son propre namespace Pinecone.
+    La recherche MMR récupère fetch_k candidats en une requête puis en garde
+    k diversifiés, pour éviter des passages quasi identiques dans le contexte.
     """
-    vectorstore = PineconeVectorStore.from_existing_index(
-        index_name=PINECONE_INDEX_NAME,
-        embedding=embeddings,
-        namespace=PINECONE_NAMESPACE,
-    )
-    return vectorstore.as_retriever(
+    return get_vectorstore().as_retriever(
+        search_type="mmr",
         search_kwargs={
             "k": 5,
-            "filter": {"doc_id": {"$eq": doc_id}},
-        }
+            "fetch_k": 20,
+            "lambda_mult": 0.5,
+            "namespace": doc_id,
+        },
     )
 
 def _format_docs(docs):
@@ -123,28 +294,65 @@ DEFAULT_SYSTEM_PROMPT = (
     "respond with 'I could not find that in the document.'"
 )
 
-def build_qa_chain(doc_id: str) -> RunnableParallel:
+QA_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", "{system_prompt}"),
+        MessagesPlaceholder("history", optional=True),
+        ("human", "Context:\n{context}\n\nQuestion: {question}"),
+    ]
+)
+
+@lru_cache(maxsize=1)
+def get_generation_chain() -> Runnable:
+    """Génération seule, à partir d'un contexte déjà récupéré."""
+    return QA_PROMPT | get_llm() | StrOutputParser()
+
+@lru_cache(maxsize=256)
+def build_qa_chain(doc_id: str) -> Runnable:
     """
     Construit la chaîne RAG pour un document spécifique.
+    La chaîne est mise en cache par doc_id.
+    Entrée : {"question": str, "history": list[BaseMessage]} ; seule la
+    question sert à la recherche, l'historique n'est transmis qu'au LLM.
     """
     retriever = get_retriever_for_doc(doc_id)
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", "{system_prompt}"),
-            ("human", "Context:\n{context}\n\nQuestion: {question}"),
-        ]
+    # Une seule recherche : la réponse et les sources consomment les mêmes passages
+    retrieve = RunnableParallel(
+        question=itemgetter("question"),
+        history=lambda x: x.get("history") or [],
+        docs=itemgetter("question") | retriever,
     )
     answer_chain = (
         {
-            "context": retriever | RunnableLambda(_format_docs),
-            "question": RunnablePassthrough(),
+            "context": lambda x: _format_docs(x["docs"]),
+            "question": itemgetter("question"),
+            "history": itemgetter("history"),
             "system_prompt": lambda _: DEFAULT_SYSTEM_PROMPT,
         }
-        | prompt
-        | llm
-        | StrOutputParser()
+        | get_generation_chain()
     )
-    return RunnableParallel(
+    return retrieve | RunnableParallel(
         answer=answer_chain,
-        source_documents=retriever,
-    )
\ No newline at end of file
+        source_documents=lambda x: x["docs"],
+    )
+
+async def aretrieve(doc_id: str, question: str) -> list[Document]:
+    """Récupère les passages du document pertinents pour la question."""
+    return await get_retriever_for_doc(doc_id).ainvoke(question)
+
+def astream_answer(
+    docs: list[Document],
+    question: str,
+    history: Optional[list[BaseMessage]] = None,
+) -> AsyncIterator[str]:
+    """
+    Génère la réponse token par token à partir des passages déjà récupérés.
+    """
+    return get_generation_chain().astream(
+        {
+            "context": _format_docs(docs),
+            "question": question,
+            "history": history or [],
+            "system_prompt": DEFAULT_SYSTEM_PROMPT,
+        }
+    )